@@ -13,16 +13,21 @@
 from __future__ import annotations
 
 import asyncio
+import atexit
+import collections
 import contextlib
 import json
-from datetime import datetime
+from datetime import datetime, timedelta
 import os
 import re
 import shutil
+import signal
+import struct
 import sys
 import gzip
 import hashlib
 import traceback
+import zlib
 from urllib.parse import urljoin
 from pathlib import Path
 from typing import Any, Awaitable, BinaryIO, Callable, List, Tuple, Literal, Iterator, cast
@@ -34,16 +39,23 @@ sys.path.insert(0, str(VENV_SITE))
 import aiohttp
 from aiohttp import web
 import httpx
+import orjson
 
 
 
 LOGDIR = Path.home() / "antigravity-trace"
 SRC = Path("/Applications/Antigravity.app/Contents/Resources/app/extensions/antigravity")
 DST = Path.home() / ".antigravity/extensions/antigravity"
+SSE_DATA_PREFIX = re.compile(r'^data:[ \t]*', re.MULTILINE)
+SSE_NON_DATA_LINE = re.compile(r'^(?!data:|\s*$)', re.MULTILINE)
+FILENAME_UNSAFE_CHARS = re.compile(r'[<>:"/\\|?*\x00-\x1F]')
+# There are some stderr messages that come out with crazy high frequency
+TOO_WORDY_STDERR = re.compile(rb"could not convert a single message before hitting truncation|queryText was truncated|\) exceeds limit \(")
 
 TEMPLATE = """<!DOCTYPE html>
 <html>
 <head>
+    <meta charset="utf-8">
     <style>
         body {font-family: system-ui, -apple-system, sans-serif; margin: 0;}
         #controls {display: none;}
@@ -113,7 +125,7 @@ INTERCEPTOR = """(next) => async (req) => {
 
 def install_shim(argv: list[str]) -> None:
     if len(argv) > 2 or (len(argv) == 2 and argv[1] not in ["--verbose","--uninstall"]):
-        sys.exit(f"Usage: {argv[0]} [--verbose|--uninstall]")
+        sys.exit(f"Usage: {argv[0]} [--verbose|--uninstall|--view LOG.jsonl.gz]")
     verbose = len(argv) > 1 and argv[1] == "--verbose"
     uninstall = len(argv) > 1 and argv[1] == "--uninstall"
 
@@ -150,26 +162,113 @@ def install_shim(argv: list[str]) -> None:
 
 
 class Log:
+    """Writes the trace as gzipped jsonl. To keep records small, the first line is {"t0": isotime},
+    and each distinct label+endpoint is written once as {"e": id, "label": _, "endpoint": _}.
+    Subsequent records refer to it as {"e": id, "t": ms since t0, "d": duration ms, ...}.
+    decode_log() turns these back into self-contained records."""
     def __init__(self, verbose: bool) -> None:
-        self.ts = datetime.now().strftime("%Y.%m.%d_%H.%M.%S")
-        self.path: Path = LOGDIR / f"{self.ts}.html"
+        self.t0 = datetime.now()
+        self.ts = self.t0.strftime("%Y.%m.%d_%H.%M.%S")
+        self.path: Path = LOGDIR / f"{self.ts}.jsonl.gz"
         self.mode: Literal["absent", "preambled", "renamed"] = "absent"
         self.prev_log: dict[str, Tuple[Any,Any]] = {}
         self.verbose = verbose
+        self._sysinstr_keys: collections.deque[Tuple[Any, str]] = collections.deque(maxlen=64)
+        self._endpoint_ids: dict[str, int] = {}
+        # The log file is held open with a large buffer, flushed a second after writes, and at exit
+        self._raw_fp: BinaryIO | None = None
+        self._fp: gzip.GzipFile | None = None
+        self._flush_handle: asyncio.TimerHandle | None = None
+        # STDIO chunks waiting to be coalesced into a single trace, by endpoint
+        self._stdio_bufs: dict[str, Tuple[datetime, bytearray]] = {}
+        self._stdio_handles: dict[str, asyncio.TimerHandle] = {}
+        atexit.register(self.close)
 
     def _preamble(self, summary: str | None) -> None:
         if self.mode == "renamed" or (self.mode == "preambled" and summary is None):
             return
         if self.mode == "preambled" and summary is not None:
-            sanitized = re.sub(r'[<>:"/\\|?*\x00-\x1F]', "_", summary).strip(" .")
-            newpath = LOGDIR / f"{self.ts} - {sanitized[:120]}.html"
-            self.path.rename(newpath)
+            sanitized = FILENAME_UNSAFE_CHARS.sub("_", summary).strip(" .")
+            newpath = LOGDIR / f"{self.ts} - {sanitized[:120]}.jsonl.gz"
+            self.path.rename(newpath)  # self._fp remains valid across the rename
             self.path = newpath
         if self.mode == "absent":
-            js = (Path(__file__).resolve().parent / "antigravity-trace.js").read_text()
-            self.path.write_text(TEMPLATE.replace("// <!--antigravity-trace.js-->", js))
+            # compresslevel=1 is cheap on the cpu and still gets most of the gains on json
+            self._raw_fp = self.path.open("wb", buffering=1 << 18)
+            self._fp = gzip.GzipFile(fileobj=self._raw_fp, mode="wb", compresslevel=1)
+            self._write({"t0": self.t0.isoformat()})
         self.mode = "renamed" if summary is not None else "preambled"
 
+    def _write(self, record: dict[str, Any]) -> None:
+        assert self._fp is not None
+        # orjson appends the newline itself, so each record is a single write with no concatenation
+        self._fp.write(orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE))
+        if self._flush_handle is None:
+            with contextlib.suppress(RuntimeError):  # no running loop: we'll flush at close
+                self._flush_handle = asyncio.get_running_loop().call_later(1.0, self.flush)
+
+    def flush(self) -> None:
+        self._flush_handle = None
+        if self._fp is not None:
+            self._fp.flush()
+
+    def close(self) -> None:
+        for endpoint in list(self._stdio_bufs):
+            self.flush_stdio(endpoint)
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+        self.flush()
+        if self._fp is not None:
+            self._fp.close()  # GzipFile doesn't close a fileobj it was given
+            self._fp = None
+        if self._raw_fp is not None:
+            self._raw_fp.close()
+            self._raw_fp = None
+
+    def wants(self, endpoint: str) -> bool:
+        """Whether trace() would log this endpoint. If not, callers needn't bother collecting its bodies."""
+        return self.verbose or 'streamGenerateContent' in endpoint
+
+    def trace_stdio(self, endpoint: Literal["STDIN", "STDOUT", "STDERR"], chunk: bytes) -> None:
+        """Like trace("STDIO", ...), but coalesces the chunks that arrive within 10ms into a single trace,
+        since a chatty process would otherwise pay for the whole trace pipeline on every small chunk"""
+        if not self.wants(endpoint):
+            return
+        if endpoint not in self._stdio_bufs:
+            self._stdio_bufs[endpoint] = (datetime.now(), bytearray())
+        buf = self._stdio_bufs[endpoint][1]
+        buf.extend(chunk)
+        if len(buf) >= 256 * 1024:
+            self.flush_stdio(endpoint)
+        elif endpoint not in self._stdio_handles:
+            try:
+                self._stdio_handles[endpoint] = asyncio.get_running_loop().call_later(0.01, self.flush_stdio, endpoint)
+            except RuntimeError:  # no running loop to flush later
+                self.flush_stdio(endpoint)
+
+    def flush_stdio(self, endpoint: str) -> None:
+        handle = self._stdio_handles.pop(endpoint, None)
+        if handle is not None:
+            handle.cancel()
+        if endpoint not in self._stdio_bufs:
+            return
+        startTime, buf = self._stdio_bufs.pop(endpoint)
+        if endpoint == "STDIN":
+            self.trace("STDIO", endpoint, startTime, bytes(buf), None, None, None)
+        else:
+            self.trace("STDIO", endpoint, startTime, None, None, bytes(buf), None)
+
+    def _sysinstr_key(self, sysinstr: Any) -> str:
+        """Returns a short key that stands for this systemInstruction. Every LLM call in a conversation
+        sends the same multi-KB system prompt, so we compare against recently seen ones (cheap, and
+        no allocation) rather than serializing it afresh each time."""
+        for prev_sysinstr, key in reversed(self._sysinstr_keys):
+            if prev_sysinstr == sysinstr:
+                return key
+        key = digest(sysinstr).hex()
+        self._sysinstr_keys.append((sysinstr, key))
+        return key
+
     def _redact_headers(self, h: dict[str, str]) -> dict[str,str]:
         blocklist = {
             "authorization",
@@ -189,7 +288,7 @@ class Log:
         # centers around computing deltas to keep the logs small.
         # Our goal is only ever that our result should be human-readable.
         # (However, it's up to the renderer antigravity-trace.js to actual format the data we put out).
-        if not self.verbose and 'streamGenerateContent' not in endpoint:
+        if not self.wants(endpoint):
             return
         request2, response2 = pretty(request), pretty(response)
         k = request2
@@ -213,12 +312,14 @@ class Log:
         # Key for delta. Also key on systemInstruction: we'll only log deltas with respect to the same systemInstruction
         key = f"{label}:{endpoint}"
         if k and 'systemInstruction' in k:
-            key += ':' + json.dumps(k['systemInstruction'], sort_keys=True)
+            key += ':' + self._sysinstr_key(k['systemInstruction'])
 
         prev = self.prev_log.get(key)
         self.prev_log[key] = (request2, response2)
-        _is_changed, request2 = delta(prev[0], request2) if prev else (True, request2)
-        _is_changed, response2 = delta(prev[1], response2) if prev else (True, response2)
+        if prev:
+            # Exact repeats are common (heartbeats, retries). A plain == spots them without any diffing.
+            request2 = unchanged_delta(request2) if prev[0] == request2 else delta(prev[0], request2)[1]
+            response2 = unchanged_delta(response2) if prev[1] == response2 else delta(prev[1], response2)[1]
         # but keying on systemInstruction is confusing, so if the new one is shown as "..." then show truncated contents
         k1 = request2
         if k and isinstance(k1, dict):
@@ -231,13 +332,15 @@ class Log:
         if 'UpdateCascadeTrajectorySummaries' in endpoint:
             request2 = {k: v for k, v in request2.items() if k.startswith(("+", "-"))}
 
+        eid = self._endpoint_ids.get(f"{label}:{endpoint}")
+        if eid is None:
+            eid = self._endpoint_ids[f"{label}:{endpoint}"] = len(self._endpoint_ids)
+            self._write({"e": eid, "label": label, "endpoint": endpoint})
         now = datetime.now()
         d: dict[str,Any] = {
-            "label": label,
-            "endpoint": endpoint,
-            "time": startTime.strftime("%H:%M:%S.%f")[:-3],
-            "endTime": now.strftime("%H:%M:%S.%f")[:-3],
-            "duration": round((now - startTime).total_seconds(), 3),
+            "e": eid,
+            "t": (startTime - self.t0) // timedelta(milliseconds=1),
+            "d": (now - startTime) // timedelta(milliseconds=1),
         }
         if request2 is not None:
             d["request"] = request2
@@ -247,8 +350,61 @@ class Log:
             d["response"] = response2
         if resp_headers is not None:
             d["resp_headers"] = self._redact_headers(resp_headers)
-        with self.path.open("a") as f:
-            f.write(json.dumps(d).replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;") + "\n")
+        self._write(d)
+
+def read_gzip(path: Path) -> bytes:
+    """Decompresses as much of the file as is there. (A log that's still being written
+    has no gzip trailer yet, may end part way through a line, and if the writer was killed
+    part way through a write, may end in garbage.)"""
+    data = path.read_bytes()
+    out: list[bytes] = []
+    pos = 0
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    try:
+        # In small pieces, so that if the tail is corrupt we still keep nearly everything before it
+        while pos < len(data):
+            end = min(pos + 4096, len(data))
+            out.append(decompressor.decompress(data[pos:end]))
+            pos = end
+            if decompressor.eof:  # another gzip member may follow
+                pos -= len(decompressor.unused_data)
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    except zlib.error:
+        pass
+    jsonl = b"".join(out)
+    return jsonl[:jsonl.rfind(b"\n") + 1]
+
+def decode_log(jsonl: bytes) -> Iterator[dict[str, Any]]:
+    """Undoes the compact encoding that Log writes, yielding each record with its
+    label, endpoint, time, endTime and duration spelled out (as antigravity-trace.js expects)"""
+    t0 = datetime.now()
+    endpoints: dict[int, Tuple[str, str]] = {}
+    for line in jsonl.splitlines():
+        r: dict[str, Any] = orjson.loads(line)
+        if "t0" in r:
+            t0 = datetime.fromisoformat(r["t0"])
+        elif "t" not in r:
+            endpoints[r["e"]] = (r["label"], r["endpoint"])
+        else:
+            label, endpoint = endpoints[r.pop("e")]
+            startTime = t0 + timedelta(milliseconds=r.pop("t"))
+            duration = r.pop("d")
+            yield {
+                "label": label,
+                "endpoint": endpoint,
+                "time": startTime.strftime("%H:%M:%S.%f")[:-3],
+                "endTime": (startTime + timedelta(milliseconds=duration)).strftime("%H:%M:%S.%f")[:-3],
+                "duration": duration / 1000,
+                **r,
+            }
+
+def render_html(path: Path) -> Path:
+    """Renders a .jsonl.gz log into a standalone .html file alongside it, and returns its path"""
+    js = (Path(__file__).resolve().parent / "antigravity-trace.js").read_text()
+    jsonl = b"".join(orjson.dumps(d, option=orjson.OPT_APPEND_NEWLINE) for d in decode_log(read_gzip(path)))
+    html_path = path.with_name(path.name.removesuffix(".jsonl.gz") + ".html")
+    html_path.write_bytes(TEMPLATE.replace("// <!--antigravity-trace.js-->", js).encode('utf-8') + jsonl.replace(b"&", b"&amp;").replace(b"<", b"&lt;").replace(b">", b"&gt;"))
+    return html_path
 
 def delta(prev: Any, new: Any) -> Tuple[bool, Any]:
     """Given two json values, returns a bool for whether they're identical,
@@ -265,77 +421,146 @@ def delta(prev: Any, new: Any) -> Tuple[bool, Any]:
     if the changed list can best be expressed as some added and some removed items,
     then `k-:[_], k+:[_]`
     """
-    if isinstance(prev, dict) and isinstance(new, dict):
-        prevl, newl = cast(dict[str,Any], prev), cast(dict[str,Any], new)
-        prev_keys = set(prevl.keys())
-        new_keys = set(newl.keys())
-        d: dict[str, Any] = {}
+    # Dispatch on exact types: json values are never subclasses, and this is hot recursive code
+    if type(prev) is not type(new):
+        return (prev == new, new)
+    elif type(new) is dict:
+        return _delta_dict(cast(dict[str, Any], prev), cast(dict[str, Any], new))
+    elif type(new) is list:
+        return _delta_list(cast(list[Any], prev), cast(list[Any], new))
+    else:
+        return (prev == new, new)
 
-        for k in sorted(prev_keys - new_keys):
+def _delta_dict(prev: dict[str, Any], new: dict[str, Any]) -> Tuple[bool, Any]:
+    d: dict[str, Any] = {}
+
+    for k in sorted(prev.keys() | new.keys()):
+        if k not in new:
             d[f"-{k}"] = None
-        for k in sorted(new_keys - prev_keys):
-            d[f"+{k}"] = newl[k]
-        for k in sorted(prev_keys & new_keys):
-            identical, subdelta = delta(prevl[k], newl[k])
-            if identical:
-                if len(json.dumps(newl[k])) < 128:
-                    d[k] = newl[k]
-                elif isinstance(newl[k], dict):
-                    d[k] = {"[unchanged]":"[unchanged]"}
-                elif isinstance(newl[k], list):
-                    d[k] = ["..."]
-                elif isinstance(newl[k], str):
-                    d[k] = "[unchanged]"
-                continue
-            if not isinstance(subdelta, list) or (subdelta[0] != "---" and subdelta[0] != "..."):
-                d[f"*{k}"] = subdelta
-                continue
-            subdeltal = cast(list[Any], subdelta)
-            iremove = next((i for i, x in enumerate(subdeltal) if x == "---"), None)
-            removals = [] if iremove is None else subdeltal[iremove+1:]
-            additions = [] if iremove == 0 else subdeltal[1:] if iremove is None else subdeltal[1:iremove]
-            if len(removals) > 0:
-                d[f"{k}-"] = removals
-            if len(additions) > 0:
-                d[f"{k}+"] = additions
-        return (len(d) == 0, "{[repeat]}" if len(d) == 0 else d)
-    elif isinstance(prev, list) and isinstance(new, list):
-        prevl = [(v,blake2b(json.dumps(v, sort_keys=True))) for v in cast(list[Any], prev)]
-        newl = [(v,blake2b(json.dumps(v, sort_keys=True))) for v in cast(list[Any], new)]
-        removals: list[Any] = []
-        additions: list[Any] = []
-        for (pv,ph) in prevl:
-            ni = next((ni for ni, (_nv,nh) in enumerate(newl) if ph == nh), None)
-            if ni is None:
-                removals.append(pv)
-            else:
-                additions.extend((nv for (nv, _nh) in newl[:ni]))
-                newl = newl[ni+1:]
-        additions.extend((nv for (nv, _nh) in newl))
-        new2 = cast(list[Any], new)
-        if len(removals) == 0 and len(additions) == 0:
-            return (True, new2)
-        elif len(removals) + len(additions) < len(new2):
-            return (False, ["...", *additions] if len(removals) == 0 else ["---", *removals] if len(additions) == 0 else ["...", *additions, "---", *removals])
+            continue
+        if k not in prev:
+            d[f"+{k}"] = new[k]
+            continue
+        identical, subdelta = delta(prev[k], new[k])
+        if identical:
+            v = new[k]
+            if is_small_json(v, 128):
+                d[k] = v
+            elif type(v) is dict:
+                d[k] = {"[unchanged]":"[unchanged]"}
+            elif type(v) is list:
+                d[k] = ["..."]
+            elif type(v) is str:
+                d[k] = "[unchanged]"
+            continue
+        if type(subdelta) is not list or (subdelta[0] != "---" and subdelta[0] != "..."):
+            d[f"*{k}"] = subdelta
+            continue
+        subdeltal = cast(list[Any], subdelta)
+        iremove = next((i for i, x in enumerate(subdeltal) if x == "---"), None)
+        removals = [] if iremove is None else subdeltal[iremove+1:]
+        additions = [] if iremove == 0 else subdeltal[1:] if iremove is None else subdeltal[1:iremove]
+        if len(removals) > 0:
+            d[f"{k}-"] = removals
+        if len(additions) > 0:
+            d[f"{k}+"] = additions
+    return (len(d) == 0, "{[repeat]}" if len(d) == 0 else d)
+
+def _delta_list(prev: list[Any], new: list[Any]) -> Tuple[bool, Any]:
+    # The common case is a conversation that has grown by a turn or two, which needn't hash anything
+    if 0 < len(prev) < len(new) and new[:len(prev)] == prev:
+        return (False, ["...", *new[len(prev):]])
+    # Index of where each item appears in new, so we can match each prev item in a single pass
+    index: dict[bytes, collections.deque[int]] = {}
+    for i, v in enumerate(new):
+        index.setdefault(digest(v), collections.deque()).append(i)
+    removals: list[Any] = []
+    additions: list[Any] = []
+    cursor = 0  # items of new before this have already been matched or counted as additions
+    for pv in prev:
+        positions = index.get(digest(pv))
+        while positions and positions[0] < cursor:
+            positions.popleft()
+        if not positions:
+            removals.append(pv)
         else:
-            return (False, new2)
+            ni = positions.popleft()
+            additions.extend(new[cursor:ni])
+            cursor = ni + 1
+    additions.extend(new[cursor:])
+    if len(removals) == 0 and len(additions) == 0:
+        return (True, new)
+    elif len(removals) + len(additions) < len(new):
+        return (False, ["...", *additions] if len(removals) == 0 else ["---", *removals] if len(additions) == 0 else ["...", *additions, "---", *removals])
     else:
-        return (prev == new, new)
+        return (False, new)
+
+def unchanged_delta(v: Any) -> Any:
+    """Returns the same as delta(v, v)[1], but cheaply: when nothing has changed
+    there's no need to hash list items or to compare anything."""
+    if type(v) is not dict:
+        return v
+    vd = cast(dict[str, Any], v)
+    d: dict[str, Any] = {}
+    for k in sorted(vd):
+        x = vd[k]
+        if type(x) is dict:
+            xd = cast(dict[str, Any], x)
+            if len(xd) > 0:
+                d[f"*{k}"] = unchanged_delta(xd)
+            else:
+                d[k] = xd
+        elif is_small_json(x, 128):
+            d[k] = x
+        elif type(x) is list:
+            d[k] = ["..."]
+        elif type(x) is str:
+            d[k] = "[unchanged]"
+    return "{[repeat]}" if len(d) == 0 else d
+
+def is_small_json(v: Any, limit: int) -> bool:
+    """Whether json.dumps(v) is shorter than limit. This gives up as soon as the running total
+    reaches limit, so it's cheap even on huge values (unlike serializing them)."""
+    size = 0
+    pending = [v]
+    while pending:
+        x = pending.pop()
+        if type(x) is str:
+            # Escaping only ever lengthens a string, so a long one needn't be encoded to know it's too big
+            size += len(x) + 2 if len(x) + 2 >= limit - size else len(json.dumps(x))
+        elif type(x) is dict:
+            xd = cast(dict[str, Any], x)
+            size += 2 + 4 * len(xd) - (2 if xd else 0)  # braces, ": " per key, ", " between items
+            for k, kv in xd.items():
+                if size >= limit:
+                    return False
+                size += len(k) + 2 if len(k) + 2 >= limit - size else len(json.dumps(k))
+                pending.append(kv)
+        elif type(x) is list:
+            xl = cast(list[Any], x)
+            size += 2 + 2 * len(xl) - (2 if xl else 0)  # brackets, ", " between items
+            pending.extend(xl)
+        else:
+            size += len(json.dumps(x))
+        if size >= limit:
+            return False
+    return True
 
-def pretty_proto(buf: bytes) -> Any:
+def pretty_proto(buf: bytes | memoryview) -> Any:
     """Parse protobuf wire format supporting wire types 0,1,2,5. Throws if parse fails."""
-    def read_varint(data: bytes, pos: int) -> Tuple[int, int]:
-        shift = 0
-        value = 0
-        while pos < len(data):
-            b = data[pos]
-            pos += 1
+    def read_varint(data: memoryview, pos: int) -> Tuple[int, int]:
+        b = data[pos]
+        if b < 0x80:  # fast path: most tags and lengths fit in one byte
+            return b, pos + 1
+        value = b & 0x7F
+        for shift in range(7, 70, 7):
+            b = data[pos + shift // 7]
             value |= (b & 0x7F) << shift
             if b < 0x80:
-                return value, pos
-            shift += 7
-        assert False, "truncated varint"
+                return value & 0xFFFFFFFFFFFFFFFF, pos + shift // 7 + 1
+        assert False, "varint too long"
 
+    buf = memoryview(buf)  # so that slicing out each field doesn't copy
     pos = 0
     out: List[Any] = []
     while pos < len(buf):
@@ -346,7 +571,7 @@ def pretty_proto(buf: bytes) -> Any:
             out.append(val)
         elif wire == 1:  # 64-bit
             assert pos + 8 <= len(buf), "64bit bounds"
-            out.append(int.from_bytes(buf[pos : pos + 8], "little"))
+            out.append(struct.unpack_from("<Q", buf, pos)[0])
             pos += 8
         elif wire == 2:  # length-delimited
             length, pos = read_varint(buf, pos)
@@ -355,7 +580,7 @@ def pretty_proto(buf: bytes) -> Any:
             pos += length
         elif wire == 5:
             assert pos + 4 <= len(buf), "32bit bounds"
-            out.append(int.from_bytes(buf[pos : pos + 4], "little"))
+            out.append(struct.unpack_from("<I", buf, pos)[0])
             pos += 4
         else:
             assert False, "wire type"
@@ -366,45 +591,48 @@ def pretty_proto(buf: bytes) -> Any:
     return out
 
 
-def pretty(buf: bytes | str | None) -> Any:
+def pretty(buf: bytes | memoryview | str | None) -> Any:
     if buf is None:
         return buf
     
     # Binary payloads are either protobuf, hex, or strings
-    if isinstance(buf, bytes):
-        try:
-            return pretty_proto(buf)
-        except Exception:
-            pass
-        hex = buf.hex()
+    if isinstance(buf, (bytes, memoryview)):
+        # The first byte of protobuf is a tag whose low three bits are the wire type. That's enough to
+        # rule out json '{' '[' and sse 'data:' (wire types 3 and 4) without a doomed parse of the whole body.
+        if len(buf) == 0 or buf[0] & 0x7 in (0, 1, 2, 5):
+            try:
+                return pretty_proto(buf)
+            except Exception:
+                pass
+        # Only pay for hex (twice the size of buf) when it's what we return, which is rare
         try:
-            buf = buf.decode('utf-8').strip()
-            if len(hex) < len(buf):
-                return hex
+            text = str(buf, 'utf-8').strip()
         except UnicodeDecodeError:
-            return hex
+            return buf.hex()
+        if 2 * len(buf) < len(text):
+            return buf.hex()
+        buf = text
     
-    # Strings may be SSE format, in which case reconstruct them
-    if all((s.startswith("data:") or not s.strip() for s in buf.splitlines())):
-        buf = '\n'.join([s[5:].lstrip() for s in buf.splitlines() if s.startswith("data:")])
+    # Strings may be SSE format (every line is "data:" or blank), in which case reconstruct them
+    if not SSE_NON_DATA_LINE.search(buf):
+        buf = SSE_DATA_PREFIX.sub('', buf)
 
     # Strings may be JSON or JSONL
     try:
-        return json.loads(buf)
+        return orjson.loads(buf)
     except Exception:
         pass
     try:
-        return [json.loads(line) for line in buf.splitlines() if line.strip()]
+        return [orjson.loads(line) for line in buf.splitlines() if line.strip()]
     except Exception:
         pass
 
     # Otherwise, just a string!
     return buf
 
-def blake2b(s: str) -> bytes:
-    h = hashlib.blake2b(digest_size=20)
-    h.update(s.encode('utf-8'))
-    return h.digest()
+def digest(v: Any) -> bytes:
+    """A fingerprint of a json value, for cheap equality tests"""
+    return hashlib.sha1(orjson.dumps(v, option=orjson.OPT_SORT_KEYS)).digest()
 
 class Protobuf:
     @staticmethod
@@ -553,9 +781,7 @@ async def start_lsp_proxy(log: Log, go_port: int) -> tuple[int, Callable[[], Awa
 
 HOP_HEADERS = {"connection", "keep-alive", "proxy-authenticate", "proxy-authorization", "te", "trailers", "transfer-encoding", "upgrade", "content-length"}
 
-async def start_extension_proxy(log: Log, target_port: int) -> tuple[int, Callable[[], Awaitable[None]]]:
-    session = aiohttp.ClientSession(auto_decompress=False)
-
+async def start_extension_proxy(log: Log, session: aiohttp.ClientSession, target_port: int) -> tuple[int, Callable[[], Awaitable[None]]]:
     cleanup_https: Callable[[], Awaitable[None]] | None = None
     cleanup_lsp: Callable[[], Awaitable[None]] | None = None
 
@@ -586,15 +812,28 @@ async def start_extension_proxy(log: Log, target_port: int) -> tuple[int, Callab
             response = web.StreamResponse(status=resp.status, headers=headers)
             await response.prepare(request)
 
-            resp_body_chunks: list[bytes] = []
+            # For the log, we decompress incrementally as chunks arrive (and don't keep them at all if they won't be logged)
+            logged = log.wants(str(request.rel_url))
+            gzipped = resp.headers.get("content-encoding", "") == "gzip" or resp.headers.get("connect-content-encoding", "") == "gzip"
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzipped and logged else None
+            log_resp_chunks: list[bytes] = []
             async for chunk in resp.content.iter_any():
-                resp_body_chunks.append(chunk)
                 await response.write(chunk)
+                if logged:
+                    try:
+                        log_resp_chunks.append(decompressor.decompress(chunk) if decompressor else chunk)
+                    except zlib.error:
+                        # e.g. connect-content-encoding gzips each enveloped message separately, so the body as a whole
+                        # isn't a gzip stream. That mustn't stop the forwarding, so we just give up on logging it.
+                        logged, decompressor, log_resp_chunks = False, None, []
             await response.write_eof()
-            
-            resp_body = b"".join(resp_body_chunks)
-            log_resp_body = gzip.decompress(resp_body) if resp.headers.get("content-encoding", "") == "gzip" or resp.headers.get("connect-content-encoding", "") == "gzip" else resp_body
-            log.trace("EXTENSION", str(request.rel_url), datetime.now(), req_body, dict(request.headers), log_resp_body, dict(resp.headers))
+            if decompressor:
+                try:
+                    log_resp_chunks.append(decompressor.flush())
+                except zlib.error:
+                    logged = False
+            if logged:
+                log.trace("EXTENSION", str(request.rel_url), datetime.now(), req_body, dict(request.headers), b"".join(log_resp_chunks), dict(resp.headers))
             return response
 
     app = web.Application()
@@ -607,7 +846,6 @@ async def start_extension_proxy(log: Log, target_port: int) -> tuple[int, Callab
 
     async def cleanup() -> None:
         await runner.cleanup()
-        await session.close()
         if cleanup_lsp:
             await cleanup_lsp()
         if cleanup_https:
@@ -615,18 +853,8 @@ async def start_extension_proxy(log: Log, target_port: int) -> tuple[int, Callab
 
     return port, cleanup
 
-async def start_web_proxy(log: Log, base_url_str: str, label: Literal["INFERENCE", "API", "CLOUD"]) -> tuple[str, Callable[[], Awaitable[None]]]:
+async def start_web_proxy(log: Log, session: httpx.AsyncClient, base_url_str: str, label: Literal["INFERENCE", "API", "CLOUD"]) -> tuple[str, Callable[[], Awaitable[None]]]:
     """Expose a local URL that forwards to base_url, keeping scheme/host intact."""
-    transport = httpx.AsyncHTTPTransport(
-        http2=True,
-        limits=httpx.Limits(max_keepalive_connections=10, max_connections=20),
-    )
-    session: httpx.AsyncClient = httpx.AsyncClient(
-        transport=transport,
-        timeout=None,
-        headers={"accept-encoding": "identity"},
-    )
-
     async def handle(request: web.Request) -> web.StreamResponse:
         req_body = await request.read()
         startTime = datetime.now()
@@ -644,14 +872,28 @@ async def start_web_proxy(log: Log, base_url_str: str, label: Literal["INFERENCE
             stream = web.StreamResponse(status=resp.status_code, headers=out_headers)
             await stream.prepare(request)
 
-            resp_body_chunks: list[bytes] = []
+            # For the log, we decompress incrementally as chunks arrive (and don't keep them at all if they won't be logged)
+            logged = log.wants(str(request.rel_url))
+            gzipped = resp.headers.get("content-encoding", "") == "gzip" or resp.headers.get("connect-content-encoding", "") == "gzip"
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzipped and logged else None
+            log_resp_chunks: list[bytes] = []
             async for chunk in resp.aiter_raw():
-                resp_body_chunks.append(chunk)
                 await stream.write(chunk)
+                if logged:
+                    try:
+                        log_resp_chunks.append(decompressor.decompress(chunk) if decompressor else chunk)
+                    except zlib.error:
+                        # e.g. connect-content-encoding gzips each enveloped message separately, so the body as a whole
+                        # isn't a gzip stream. That mustn't stop the forwarding, so we just give up on logging it.
+                        logged, decompressor, log_resp_chunks = False, None, []
             await stream.write_eof()
-            resp_body = b''.join(resp_body_chunks)
-            log_resp_body = gzip.decompress(resp_body) if resp.headers.get("content-encoding", "") == "gzip" or resp.headers.get("connect-content-encoding", "") == "gzip" else resp_body
-            log.trace(label, str(request.rel_url), startTime, req_body, dict(request.headers), log_resp_body, dict(resp.headers))
+            if decompressor:
+                try:
+                    log_resp_chunks.append(decompressor.flush())
+                except zlib.error:
+                    logged = False
+            if logged:
+                log.trace(label, str(request.rel_url), startTime, req_body, dict(request.headers), b"".join(log_resp_chunks), dict(resp.headers))
         return stream
 
     app = web.Application()
@@ -664,7 +906,6 @@ async def start_web_proxy(log: Log, base_url_str: str, label: Literal["INFERENCE
 
     async def cleanup() -> None:
         await runner.cleanup()
-        await session.aclose()
 
     return f"http://127.0.0.1:{port}", cleanup
 
@@ -756,15 +997,26 @@ async def shim() -> None:
 
     args = parse_argv(sys.argv[1:])
 
+    # The proxies share one client (and hence one connection pool) per library
+    extension_session = aiohttp.ClientSession(auto_decompress=False)
+    web_session = httpx.AsyncClient(
+        transport=httpx.AsyncHTTPTransport(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=30, max_connections=60),
+        ),
+        timeout=None,
+        headers={"accept-encoding": "identity"},
+    )
+
     uds_path, uds_cleanup = await start_uds_proxy(log, args["--parent_pipe_path"][0])
     args["--parent_pipe_path"] = [uds_path]
-    extension_server_port, extension_server_cleanup = await start_extension_proxy(log, int(args["--extension_server_port"][0]))
+    extension_server_port, extension_server_cleanup = await start_extension_proxy(log, extension_session, int(args["--extension_server_port"][0]))
     args["--extension_server_port"] = [str(extension_server_port)]
-    inference_url, inference_cleanup = await start_web_proxy(log, args["--inference_api_server_url"][0], 'INFERENCE')
+    inference_url, inference_cleanup = await start_web_proxy(log, web_session, args["--inference_api_server_url"][0], 'INFERENCE')
     args["--inference_api_server_url"] = [inference_url]
-    api_url, api_cleanup = await start_web_proxy(log, args["--api_server_url"][0], 'API')
+    api_url, api_cleanup = await start_web_proxy(log, web_session, args["--api_server_url"][0], 'API')
     args["--api_server_url"] = [api_url]
-    cloud_url, cloud_cleanup = await start_web_proxy(log, args["--cloud_code_endpoint"][0], 'CLOUD')
+    cloud_url, cloud_cleanup = await start_web_proxy(log, web_session, args["--cloud_code_endpoint"][0], 'CLOUD')
     args["--cloud_code_endpoint"] = [cloud_url]
     # Some additional interception is installed within extension_proxy when it intercepts /LanguageServerStarted
 
@@ -779,32 +1031,39 @@ async def shim() -> None:
     assert proc.stdout is not None
     assert proc.stderr is not None
 
-    async def pump_output(reader: asyncio.StreamReader, writer: BinaryIO, label: Literal["STDOUT","STDERR"]) -> None:
+    # Our own stdio is wired straight into the event loop, rather than blocking reads and writes
+    loop = asyncio.get_running_loop()
+    # On SIGTERM, pass it on and then shut down normally once the child exits, so atexit gets to close the log.
+    # (Handling it on the event loop means it never interrupts a write to the log part way through.)
+    loop.add_signal_handler(signal.SIGTERM, proc.terminate)
+    stdin_reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(stdin_reader), sys.stdin.buffer)
+
+    async def connect_writer(f: BinaryIO) -> asyncio.StreamWriter:
+        transport, protocol = await loop.connect_write_pipe(asyncio.streams.FlowControlMixin, f)
+        return asyncio.StreamWriter(transport, protocol, None, loop)
+
+    async def pump_output(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, label: Literal["STDOUT","STDERR"]) -> None:
         while True:
             chunk = await reader.read(64 * 1024)
             if not chunk:
                 break
-            # There are some stderr messages that come out with crazy high frequency
-            too_wordy = [b"could not convert a single message before hitting truncation",
-                b"queryText was truncated",
-                b") exceeds limit ("]
-            if label == "STDERR" and any((w in chunk for w in too_wordy)):
-                pass
-            else:
-                log.trace("STDIO", label, datetime.now(), None, None, chunk, None)
+            # Most of the time (unless --verbose) stdio isn't logged, so don't even look at the chunk
+            if log.wants(label) and not (label == "STDERR" and TOO_WORDY_STDERR.search(chunk)):
+                log.trace_stdio(label, chunk)
             try:
                 writer.write(chunk)
-                writer.flush()
-            except BrokenPipeError:
+                await writer.drain()
+            except ConnectionError:
                 break
 
     async def pump_input() -> None:
         try:
             while True:
-                chunk = await asyncio.to_thread(sys.stdin.buffer.read, 64 * 1024)
+                chunk = await stdin_reader.read(64 * 1024)
                 if not chunk:
                     break
-                log.trace("STDIO", "STDIN", datetime.now(), chunk, None, None, None)
+                log.trace_stdio("STDIN", chunk)
                 assert proc.stdin is not None
                 proc.stdin.write(chunk)
                 await proc.stdin.drain()
@@ -815,8 +1074,8 @@ async def shim() -> None:
                 await proc.stdin.wait_closed()
 
 
-    stdout = asyncio.create_task(pump_output(proc.stdout, sys.stdout.buffer, "STDOUT"))
-    stderr = asyncio.create_task(pump_output(proc.stderr, sys.stderr.buffer, "STDERR"))
+    stdout = asyncio.create_task(pump_output(proc.stdout, await connect_writer(sys.stdout.buffer), "STDOUT"))
+    stderr = asyncio.create_task(pump_output(proc.stderr, await connect_writer(sys.stderr.buffer), "STDERR"))
     stdin = asyncio.create_task(pump_input())
     returncode = await proc.wait()
 
@@ -832,10 +1091,15 @@ async def shim() -> None:
     await api_cleanup()
     await cloud_cleanup()
     await uds_cleanup()
-    sys.exit(returncode)
+    await extension_session.close()
+    await web_session.aclose()
+    sys.exit(128 - returncode if returncode < 0 else returncode)  # a child killed by signal N exits as 128+N, like a shell
 
 
 if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "--view":
+        print(f"Rendered {render_html(Path(sys.argv[2]))}")
+        sys.exit(0)
     try:
         install_shim(sys.argv) if len(sys.argv) <= 2 else asyncio.run(shim())
     except Exception as e: